@@ -1,10 +1,68 @@
 """Prefect kubernetes agent."""
-from logging import INFO, StreamHandler, getLogger
-from typing import cast, Dict, List
+import asyncio
+import hashlib
+import json
+import random
+from copy import deepcopy
+from functools import lru_cache
+from logging import getLogger, INFO, Logger, StreamHandler
+from typing import Any, Awaitable, Callable, cast, Dict, List, Optional, Tuple
+
 import prefect
-from kubernetes import client, config
-from kubernetes.client.exceptions import ApiException
-from pydantic import BaseModel
+from kubernetes_asyncio import client, config
+from kubernetes_asyncio.client.exceptions import ApiException
+from pydantic import BaseModel, PrivateAttr
+
+from perfect_deployer.implementations.infra.eks import (
+    get_kube_api_concurrency,
+    KUBE_API_RETRIES,
+    KUBE_API_RETRY_DELAY_SECONDS,
+    KUBE_API_RETRY_STATUSES,
+)
+
+FIELD_MANAGER = "perfect-deployer"
+SPEC_HASH_ANNOTATION = "perfect-deployer.io/spec-hash"
+
+
+def _with_spec_hash(manifest: Dict[str, Any]) -> Dict[str, Any]:
+    """Return a copy of a manifest annotated with the hash of its content."""
+    spec_hash = hashlib.sha256(
+        json.dumps(manifest, sort_keys=True).encode()
+    ).hexdigest()
+    metadata = manifest["metadata"]
+    annotations = {**metadata.get("annotations", {}), SPEC_HASH_ANNOTATION: spec_hash}
+    return {**manifest, "metadata": {**metadata, "annotations": annotations}}
+
+
+def _log_apply(logger: Logger, resource: str, applied: bool) -> None:
+    """Log whether a resource was applied or left unchanged."""
+    logger.info(f"{resource} {'updated' if applied else 'unchanged'}")
+
+
+@lru_cache(maxsize=1)
+def _load_profile_env(name: str) -> Tuple[Tuple[str, str], ...]:
+    """Load the environment variables of a prefect profile.
+
+    Profiles are read from disk, so the result is cached per profile name.
+    """
+    profiles = prefect.settings.load_profiles()
+
+    if name not in profiles:
+        raise ValueError(f"Profile {name!r} not found.")
+
+    profile = profiles[name]
+    settings = profile.settings
+
+    if not settings:
+        raise ValueError(f"Profile {name!r} is empty.")
+
+    return (
+        ("PREFECT_KUBERNETES_CLUSTER_UID", "1"),
+        *(
+            (cast(str, setting.name), str(setting.value()))
+            for setting in cast(Dict[prefect.settings.Setting[str], str], settings)
+        ),
+    )
 
 
 class PrefectKubernetesAgent(BaseModel):
@@ -18,6 +76,53 @@ class PrefectKubernetesAgent(BaseModel):
     cpu: float = 1
     memory_gb: float = 0.5
 
+    _api_client: Optional[client.ApiClient] = PrivateAttr(default=None)
+    _api_semaphore: Optional[asyncio.Semaphore] = PrivateAttr(default=None)
+    _templates: Dict[str, Dict[str, Any]] = PrivateAttr(default_factory=dict)
+    _templates_fields: Optional[Dict[str, Any]] = PrivateAttr(default=None)
+    _manifests: Dict[str, Dict[str, Any]] = PrivateAttr(default_factory=dict)
+    _manifests_key: Optional[Tuple[Dict[str, Any], str]] = PrivateAttr(default=None)
+
+    @property
+    def api_client(self) -> client.ApiClient:
+        """Return the api client shared by all kubernetes api calls."""
+        if self._api_client is None:
+            self._api_client = client.ApiClient()
+        return self._api_client
+
+    async def _close_api_client(self) -> None:
+        """Close the shared api client and its http session."""
+        if self._api_client is None:
+            return
+        await self._api_client.close()
+        self._api_client = None
+
+    @property
+    def api_semaphore(self) -> asyncio.Semaphore:
+        """Return the semaphore bounding concurrent kubernetes api calls."""
+        if self._api_semaphore is None:
+            self._api_semaphore = asyncio.Semaphore(get_kube_api_concurrency())
+        return self._api_semaphore
+
+    async def _call_api(
+        self, call: Callable[..., Awaitable[Any]], **kwargs: Any
+    ) -> Any:
+        """Call the kubernetes api, retrying with backoff when it is overloaded."""
+        for attempt in range(KUBE_API_RETRIES):
+            try:
+                async with self.api_semaphore:
+                    return await call(**kwargs)
+            except ApiException as exc:
+                if exc.status not in KUBE_API_RETRY_STATUSES:
+                    raise exc
+            # exponential backoff with full jitter to spread out retries
+            await asyncio.sleep(
+                random.uniform(0, KUBE_API_RETRY_DELAY_SECONDS * 2**attempt)
+            )
+
+        async with self.api_semaphore:
+            return await call(**kwargs)
+
     @property
     def limits(self) -> Dict[str, str]:
         """Return the resource limits."""
@@ -55,109 +160,93 @@ class PrefectKubernetesAgent(BaseModel):
         return command
 
     def _build_env_from_profile(self) -> List[Dict[str, str]]:
-        profiles = prefect.settings.load_profiles()
-        current_profile = prefect.context.get_settings_context().profile
-        name = current_profile.name
-
-        if name not in profiles:
-            raise ValueError(f"Profile {name!r} not found.")
-
-        profile = profiles[name]
-        settings = profile.settings
-
-        if not settings:
-            raise ValueError(f"Profile {name!r} is empty.")
+        name = prefect.context.get_settings_context().profile.name
+        return [
+            {"name": setting_name, "value": value}
+            for setting_name, value in _load_profile_env(name)
+        ]
 
-        env: List[Dict[str, str]] = [
-            {
-                "name": "PREFECT_KUBERNETES_CLUSTER_UID",
-                "value": "1",
+    def _build_namespace(self) -> Dict[str, Any]:
+        return {
+            "apiVersion": "v1",
+            "kind": "Namespace",
+            "metadata": {
+                "name": self.namespace,
             },
-        ]
-        for setting in cast(Dict[prefect.settings.Setting[str], str], settings):
-            env.append(
-                {
-                    "name": cast(str, setting.name),
-                    "value": str(setting.value()),
-                }
-            )
-        return env
-
-    def _build_namespace(self) -> client.V1Namespace:
-        return client.V1Namespace(
-            api_version="v1",
-            kind="Namespace",
-            metadata=client.V1ObjectMeta(
-                name=self.namespace,
-            ),
-        )
+        }
 
-    def _build_deployment_spec(self) -> client.V1Deployment:
-        return client.V1Deployment(
-            api_version="apps/v1",
-            kind="Deployment",
-            metadata=client.V1ObjectMeta(
-                name=self.name,
-                namespace=self.namespace,
-                labels=self.labels,
-            ),
-            spec=client.V1DeploymentSpec(
-                replicas=1,
-                selector=client.V1LabelSelector(
-                    match_labels=self.labels,
-                ),
-                template=client.V1PodTemplateSpec(
-                    metadata=client.V1ObjectMeta(
-                        labels=self.labels,
-                    ),
-                    spec=client.V1PodSpec(
-                        service_account_name=self.service_account_name,
-                        containers=[
-                            client.V1Container(
-                                name=self.name,
-                                command=self._build_command(),
-                                image=self.image,
-                                env=self._build_env_from_profile(),
-                                args=[],
-                                resources=client.V1ResourceRequirements(
-                                    limits=self.limits,
-                                    requests=self.requests,
-                                ),
-                            )
+    def _build_deployment_template(self) -> Dict[str, Any]:
+        """Build the deployment manifest, without the container environment."""
+        return {
+            "apiVersion": "apps/v1",
+            "kind": "Deployment",
+            "metadata": {
+                "name": self.name,
+                "namespace": self.namespace,
+                "labels": self.labels,
+            },
+            "spec": {
+                "replicas": 1,
+                "selector": {
+                    "matchLabels": self.labels,
+                },
+                "template": {
+                    "metadata": {
+                        "labels": self.labels,
+                    },
+                    "spec": {
+                        "serviceAccountName": self.service_account_name,
+                        "containers": [
+                            {
+                                "name": self.name,
+                                "command": self._build_command(),
+                                "image": self.image,
+                                "args": [],
+                                "resources": {
+                                    "limits": self.limits,
+                                    "requests": self.requests,
+                                },
+                            }
                         ],
-                    ),
-                ),
-            ),
-        )
+                    },
+                },
+            },
+        }
 
-    def _build_service_account(self) -> client.V1ServiceAccount:
-        return client.V1ServiceAccount(
-            api_version="v1",
-            kind="ServiceAccount",
-            metadata=client.V1ObjectMeta(
-                name=self.name,
-                namespace=self.namespace,
-            ),
-        )
+    def _build_deployment_spec(self) -> Dict[str, Any]:
+        deployment = deepcopy(self._get_templates()["deployment"])
+        container = deployment["spec"]["template"]["spec"]["containers"][0]
+        container["env"] = self._build_env_from_profile()
+        return deployment
 
-    def _build_role(self) -> client.V1Role:
-        return client.V1Role(
-            api_version="rbac.authorization.k8s.io/v1",
-            kind="Role",
-            metadata=client.V1ObjectMeta(
-                name=self.name,
-                namespace=self.namespace,
-            ),
-            rules=[
-                client.V1PolicyRule(
-                    api_groups=["*"],
-                    resources=["namespaces", "pods", "pods/log", "pods/status"],
-                    verbs=["get", "watch", "List"],
-                ),
-                client.V1PolicyRule(
-                    api_groups=["*"],
-                    resources=["jobs"],
-                    verbs=[
+    def _build_service_account(self) -> Dict[str, Any]:
+        return {
+            "apiVersion": "v1",
+            "kind": "ServiceAccount",
+            "metadata": {
+                "name": self.name,
+                "namespace": self.namespace,
+            },
+        }
+
+    def _build_role(self) -> Dict[str, Any]:
+        return {
+            "apiVersion": "rbac.authorization.k8s.io/v1",
+            "kind": "Role",
+            "metadata": {
+                "name": self.name,
+                "namespace": self.namespace,
+            },
+            "rules": [
+                {
+                    "apiGroups": ["*"],
+                    "resources": ["namespaces", "pods", "pods/log", "pods/status"],
+                    "verbs": ["get", "watch", "List"],
+                },
+                {
+                    "apiGroups": ["*"],
+                    "resources": ["jobs"],
+                    "verbs": [
                         "get",
                         "List",
                         "watch",
@@ -166,146 +255,199 @@ class PrefectKubernetesAgent(BaseModel):
                         "patch",
                         "delete",
                     ],
-                ),
+                },
             ],
-        )
+        }
 
-    def _build_role_binding(self) -> client.V1RoleBinding:
-        return client.V1RoleBinding(
-            api_version="rbac.authorization.k8s.io/v1",
-            kind="RoleBinding",
-            metadata=client.V1ObjectMeta(
-                name=self.name,
-                namespace=self.namespace,
-            ),
-            role_ref=client.V1RoleRef(
-                api_group="rbac.authorization.k8s.io",
-                kind="Role",
-                name=self.name,
-            ),
-            subjects=[
-                client.V1Subject(
-                    kind="ServiceAccount",
-                    name=self.name,
-                    namespace=self.namespace,
-                )
+    def _build_role_binding(self) -> Dict[str, Any]:
+        return {
+            "apiVersion": "rbac.authorization.k8s.io/v1",
+            "kind": "RoleBinding",
+            "metadata": {
+                "name": self.name,
+                "namespace": self.namespace,
+            },
+            "roleRef": {
+                "apiGroup": "rbac.authorization.k8s.io",
+                "kind": "Role",
+                "name": self.name,
+            },
+            "subjects": [
+                {
+                    "kind": "ServiceAccount",
+                    "name": self.name,
+                    "namespace": self.namespace,
+                }
             ],
-        )
+        }
 
-    def _update_namespace(self) -> None:
-        """Create or patch the namespace."""
-        namespace = self._build_namespace()
-        core_v1_api = client.CoreV1Api()
+    def _get_templates(self) -> Dict[str, Dict[str, Any]]:
+        """Return the manifest templates, rendered again whenever a field changed."""
+        fields = self.dict()
+        if self._templates_fields != fields:
+            self._templates = {
+                "namespace": self._build_namespace(),
+                "serviceaccount": self._build_service_account(),
+                "role": self._build_role(),
+                "rolebinding": self._build_role_binding(),
+                "deployment": self._build_deployment_template(),
+            }
+            self._templates_fields = fields
+        return self._templates
+
+    def _get_manifests(self) -> Dict[str, Dict[str, Any]]:
+        """Return the manifests of all resources, built once per fields and profile."""
+        key = (self.dict(), prefect.context.get_settings_context().profile.name)
+        if self._manifests_key != key:
+            manifests = {
+                **self._get_templates(),
+                "deployment": self._build_deployment_spec(),
+            }
+            self._manifests = {
+                kind: _with_spec_hash(manifest) for kind, manifest in manifests.items()
+            }
+            self._manifests_key = key
+        return self._manifests
+
+    async def _server_side_apply(
+        self,
+        read: Callable[..., Awaitable[Any]],
+        patch: Callable[..., Awaitable[Any]],
+        body: Dict[str, Any],
+        **kwargs: str,
+    ) -> bool:
+        """Apply a resource using kubernetes server-side apply.
+
+        The apply is skipped when the live resource already carries the spec hash
+        of the manifest, i.e. it was last applied from the same manifest.
+
+        Returns whether the resource was applied.
+        """
         try:
-            core_v1_api.create_namespace(namespace)
+            live = await self._call_api(read, **kwargs)
         except ApiException as exc:
-            if exc.status == 409:
-                # Namespace already exists
-                core_v1_api.patch_namespace(self.namespace, namespace)
-            else:
+            if exc.status != 404:
                 raise exc
+        else:
+            annotations = live.metadata.annotations or {}
+            spec_hash = body["metadata"]["annotations"][SPEC_HASH_ANNOTATION]
+            if annotations.get(SPEC_HASH_ANNOTATION) == spec_hash:
+                return False
+
+        # the body stays a dict, kubernetes-asyncio JSON-encodes apply patches
+        # since 25.11.0 (except 30.1.0) while older releases only accept bytes
+        await self._call_api(
+            patch,
+            body=body,
+            field_manager=FIELD_MANAGER,
+            force=True,
+            _content_type="application/apply-patch+yaml",
+            **kwargs,
+        )
+        return True
+
+    async def _update_namespace(self, body: Dict[str, Any]) -> bool:
+        """Apply the namespace."""
+        core_v1_api = client.CoreV1Api(self.api_client)
+        return await self._server_side_apply(
+            core_v1_api.read_namespace,
+            core_v1_api.patch_namespace,
+            body,
+            name=self.namespace,
+        )
 
-    def _apply_service_account(self) -> None:
-        service_account = self._build_service_account()
-        core_v1_api = client.CoreV1Api()
-        try:
-            core_v1_api.create_namespaced_service_account(
-                namespace=self.namespace,
-                body=service_account,
-            )
-        except ApiException as exc:
-            if exc.status == 409:
-                # Service account already exists
-                core_v1_api.patch_namespaced_service_account(
-                    name=self.name,
-                    namespace=self.namespace,
-                    body=service_account,
-                )
-            else:
-                raise exc
+    async def _apply_service_account(self, body: Dict[str, Any]) -> bool:
+        core_v1_api = client.CoreV1Api(self.api_client)
+        return await self._server_side_apply(
+            core_v1_api.read_namespaced_service_account,
+            core_v1_api.patch_namespaced_service_account,
+            body,
+            name=self.name,
+            namespace=self.namespace,
+        )
 
-    def _apply_role(self) -> None:
-        role = self._build_role()
-        rbac_v1_api = client.RbacAuthorizationV1Api()
-        try:
-            rbac_v1_api.create_namespaced_role(
-                namespace=self.namespace,
-                body=role,
-            )
-        except ApiException as exc:
-            if exc.status == 409:
-                # Role already exists
-                rbac_v1_api.patch_namespaced_role(
-                    name=self.name,
-                    namespace=self.namespace,
-                    body=role,
-                )
-            else:
-                raise exc
+    async def _apply_role(self, body: Dict[str, Any]) -> bool:
+        rbac_v1_api = client.RbacAuthorizationV1Api(self.api_client)
+        return await self._server_side_apply(
+            rbac_v1_api.read_namespaced_role,
+            rbac_v1_api.patch_namespaced_role,
+            body,
+            name=self.name,
+            namespace=self.namespace,
+        )
 
-    def _apply_role_binding(self) -> None:
-        role_binding = self._build_role_binding()
-        rbac_v1_api = client.RbacAuthorizationV1Api()
-        try:
-            rbac_v1_api.create_namespaced_role_binding(
-                namespace=self.namespace,
-                body=role_binding,
-            )
-        except ApiException as exc:
-            if exc.status == 409:
-                # Role binding already exists
-                rbac_v1_api.patch_namespaced_role_binding(
-                    name=self.name,
-                    namespace=self.namespace,
-                    body=role_binding,
-                )
-            else:
-                raise exc
+    async def _apply_role_binding(self, body: Dict[str, Any]) -> bool:
+        rbac_v1_api = client.RbacAuthorizationV1Api(self.api_client)
+        return await self._server_side_apply(
+            rbac_v1_api.read_namespaced_role_binding,
+            rbac_v1_api.patch_namespaced_role_binding,
+            body,
+            name=self.name,
+            namespace=self.namespace,
+        )
 
-    def _apply_deployment(self) -> None:
-        deployment = self._build_deployment_spec()
-        apps_v1_api = client.AppsV1Api()
-        try:
-            apps_v1_api.create_namespaced_deployment(
-                namespace=self.namespace,
-                body=deployment,
-            )
-        except ApiException as exc:
-            if exc.status == 409:
-                # Deployment already exists
-                apps_v1_api.patch_namespaced_deployment(
-                    name=self.name,
-                    namespace=self.namespace,
-                    body=deployment,
-                )
-            else:
-                raise exc
+    async def _apply_deployment(self, body: Dict[str, Any]) -> bool:
+        apps_v1_api = client.AppsV1Api(self.api_client)
+        return await self._server_side_apply(
+            apps_v1_api.read_namespaced_deployment,
+            apps_v1_api.patch_namespaced_deployment,
+            body,
+            name=self.name,
+            namespace=self.namespace,
+        )
+
+    async def _apply_rbac(
+        self, manifests: Dict[str, Dict[str, Any]]
+    ) -> Tuple[bool, bool, bool]:
+        """Apply the service account, role and role binding.
+
+        The apiserver has no endpoint accepting a list of heterogeneous kinds, so
+        the rbac resources, which only depend on the namespace, are applied
+        concurrently over the shared api client instead.
+        """
+        return await asyncio.gather(
+            self._apply_service_account(manifests["serviceaccount"]),
+            self._apply_role(manifests["role"]),
+            self._apply_role_binding(manifests["rolebinding"]),
+        )
 
     def deploy(self) -> None:
         """Deploy the agent."""
-        try:
-            config.load_kube_config()
-        except config.config_exception.ConfigException:
-            config.load_incluster_config()
-
         logger = getLogger()
         logger.setLevel(INFO)
         logger.addHandler(StreamHandler())
 
-        self._update_namespace()
-        logger.info(f"namespace/{self.namespace} updated")
+        asyncio.run(self._deploy_async(logger))
 
-        self._apply_service_account()
-        logger.info(f"serviceaccount/{self.name} updated")
+    async def _deploy_async(self, logger: Logger) -> None:
+        try:
+            await config.load_kube_config()
+        except config.ConfigException:
+            config.load_incluster_config()
+
+        try:
+            await self._deploy(logger)
+        finally:
+            await self._close_api_client()
+            # the semaphore is bound to this event loop
+            self._api_semaphore = None
 
-        self._apply_role()
-        logger.info(f"role/{self.name} updated")
+    async def _deploy(self, logger: Logger) -> None:
+        # render every manifest before the first request goes out
+        manifests = self._get_manifests()
 
-        self._apply_role_binding()
-        logger.info(f"role-binding/{self.name} updated")
+        applied = await self._update_namespace(manifests["namespace"])
+        _log_apply(logger, f"namespace/{self.namespace}", applied)
+
+        sa_applied, role_applied, role_binding_applied = await self._apply_rbac(
+            manifests
+        )
+        _log_apply(logger, f"serviceaccount/{self.name}", sa_applied)
+        _log_apply(logger, f"role/{self.name}", role_applied)
+        _log_apply(logger, f"role-binding/{self.name}", role_binding_applied)
 
-        self._apply_deployment()
-        logger.info(f"deployment/{self.name} updated")
+        applied = await self._apply_deployment(manifests["deployment"])
+        _log_apply(logger, f"deployment/{self.name}", applied)
 
 
 if __name__ == "__main__":
@@ -1,16 +1,24 @@
 """S3 Flow Storage Implementation."""
+from dataclasses import dataclass
+from typing import Any, Dict
+
 from perfect_deployer.interface import DeployableFlowBuilderInterface
-from pydantic import BaseModel
 from prefect.filesystems import S3
 from prefect.deployments import Deployment
 
 
-class s3(BaseModel, DeployableFlowBuilderInterface):
+@dataclass(frozen=True)
+class s3(DeployableFlowBuilderInterface):
     """S3 infrastructure builder."""
 
     bucket: str
     key: str
 
+    @classmethod
+    def parse_obj(cls, obj: Dict[str, Any]) -> "s3":
+        """Build the builder from a dictionary."""
+        return cls(**obj)
+
     def update_deployment(self, deployment: Deployment) -> Deployment:
         """Update deployment."""
         deployment.storage = S3(bucket_path=f"{self.bucket}/{self.key}")
@@ -1,89 +1,266 @@
 """EKS infrastructure builder."""
-import subprocess
-import tempfile
-from pathlib import Path
-from typing import Optional
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Callable, Dict, Optional, Set, TypeVar
 
+from kubernetes import client, config, watch
+from kubernetes.client.exceptions import ApiException
 from prefect.deployments import Deployment
 from prefect.infrastructure import KubernetesJob
-from pydantic import BaseModel, Field
+from prefect.utilities.asyncutils import run_sync_in_worker_thread
+from urllib3.exceptions import HTTPError
 
 from perfect_deployer.interface import DeployableFlowBuilderInterface
 
+KUBE_API_RETRIES = 4
+KUBE_API_RETRY_DELAY_SECONDS = 0.5
+KUBE_API_RETRY_STATUSES = (429, 500, 503)
 
-class eks(BaseModel, DeployableFlowBuilderInterface):
+T = TypeVar("T")
+
+
+def get_kube_api_concurrency() -> int:
+    """Read the maximum number of concurrent kubernetes api calls."""
+    value = os.getenv("PERFECT_DEPLOYER_KUBE_CONCURRENCY", "8")
+    try:
+        concurrency = int(value)
+    except ValueError:
+        concurrency = 0
+    if concurrency < 1:
+        raise ValueError(
+            "PERFECT_DEPLOYER_KUBE_CONCURRENCY must be a positive integer, "
+            f"got {value!r}"
+        )
+    return concurrency
+
+
+@lru_cache(maxsize=1)
+def _get_kube_api_semaphore() -> threading.BoundedSemaphore:
+    """Return the semaphore bounding apiserver calls of builders run in parallel."""
+    return threading.BoundedSemaphore(get_kube_api_concurrency())
+
+
+def _call_kube_api(call: Callable[..., T], **kwargs: Any) -> T:
+    """Call the kubernetes api, retrying with backoff when it is overloaded."""
+    for attempt in range(KUBE_API_RETRIES):
+        try:
+            with _get_kube_api_semaphore():
+                return call(**kwargs)
+        except ApiException as exc:
+            if exc.status not in KUBE_API_RETRY_STATUSES:
+                raise exc
+        # exponential backoff with full jitter to spread out retries
+        time.sleep(random.uniform(0, KUBE_API_RETRY_DELAY_SECONDS * 2**attempt))
+
+    with _get_kube_api_semaphore():
+        return call(**kwargs)
+
+
+@lru_cache(maxsize=1)
+def _get_api_client() -> client.ApiClient:
+    """Load the kubernetes config and return an api client shared by the module."""
+    try:
+        config.load_kube_config()
+    except config.config_exception.ConfigException:
+        config.load_incluster_config()
+    return client.ApiClient()
+
+
+class _NamespaceCache:
+    """Namespace names kept up to date by a background watch on the apiserver.
+
+    Requires permission to list and watch namespaces cluster-wide. Without it the
+    watch stops and every lookup reports a miss.
+    """
+
+    # how long a lookup waits for the initial list before reporting a miss
+    sync_timeout_seconds = 10.0
+    # delays between attempts to resume the watch after a transient failure
+    retry_delay_seconds = 0.5
+    max_retry_delay_seconds = 30.0
+
+    def __init__(self, core_v1_api: client.CoreV1Api) -> None:
+        self._core_v1_api = core_v1_api
+        self._names: Set[str] = set()
+        self._lock = threading.Lock()
+        self._synced = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __contains__(self, namespace: object) -> bool:
+        """Check whether a namespace is known to exist."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="perfect-deployer-namespaces", daemon=True
+                )
+                self._thread.start()
+
+        if not self._synced.wait(self.sync_timeout_seconds):
+            # the initial list is taking too long, do not block the caller on it
+            return False
+        if not self._thread.is_alive():
+            # the watch stopped, the cache can no longer be trusted
+            return False
+
+        with self._lock:
+            return namespace in self._names
+
+    def add(self, namespace: str) -> None:
+        """Record a namespace created outside of the watch."""
+        with self._lock:
+            self._names.add(namespace)
+
+    def _list(self) -> str:
+        """Refresh all namespace names and return the list resource version."""
+        namespaces = _call_kube_api(self._core_v1_api.list_namespace)
+        with self._lock:
+            self._names = {namespace.metadata.name for namespace in namespaces.items}
+        self._synced.set()
+        return str(namespaces.metadata.resource_version)
+
+    def _watch(self, resource_version: str) -> None:
+        """Follow namespace events until the resource version expires."""
+        while True:
+            try:
+                for event in watch.Watch().stream(
+                    self._core_v1_api.list_namespace,
+                    resource_version=resource_version,
+                ):
+                    metadata = event["object"].metadata
+                    resource_version = metadata.resource_version
+                    with self._lock:
+                        if event["type"] == "DELETED":
+                            self._names.discard(metadata.name)
+                        else:
+                            self._names.add(metadata.name)
+            except ApiException as exc:
+                if exc.status == 410:
+                    # Resource version is too old, re-list to resume the watch
+                    return
+                raise exc
+
+    def _run(self) -> None:
+        attempt = 0
+        try:
+            while True:
+                try:
+                    resource_version = self._list()
+                    attempt = 0
+                    self._watch(resource_version)
+                    continue
+                except ApiException as exc:
+                    if exc.status in (401, 403):
+                        # Not allowed to list or watch namespaces, disable the cache
+                        return
+                except HTTPError:
+                    # The connection to the apiserver dropped or timed out
+                    pass
+                # back off with full jitter before re-listing and re-watching
+                time.sleep(
+                    random.uniform(
+                        0,
+                        min(
+                            self.max_retry_delay_seconds,
+                            self.retry_delay_seconds * 2**attempt,
+                        ),
+                    )
+                )
+                attempt += 1
+        finally:
+            self._synced.set()
+
+
+@lru_cache(maxsize=1)
+def _get_namespace_cache() -> _NamespaceCache:
+    """Return the namespace cache shared by the module."""
+    return _NamespaceCache(client.CoreV1Api(_get_api_client()))
+
+
+@dataclass(frozen=True)
+class eks(DeployableFlowBuilderInterface):
     """EKS infrastructure builder."""
 
-    image: str = Field(
-        description="Docker image used to run flow.",
-        env="IMAGE",
-        default="prefecthq/prefect:2-latest-kubernetes",
+    cpu: float = field(
+        metadata={"description": "Number of virtual CPU cores to allocate to flow."},
+    )
+
+    memory_gb: float = field(
+        metadata={"description": "Amount of memory to allocate to flow in GB."},
     )
 
-    namespace: Optional[str] = Field(
-        description=(
-            "Kubernetes namespace to deploy flow to. "
-            "If not specified, will infer namespace from "
-            "deployment project name and environment."
+    image: str = field(
+        default_factory=lambda: os.getenv(
+            "IMAGE", "prefecthq/prefect:2-latest-kubernetes"
         ),
-        default=None,
+        metadata={"description": "Docker image used to run flow."},
     )
 
-    cpu: float = Field(
-        description="Number of virtual CPU cores to allocate to flow.",
-        gt=0,
-        le=64,
+    namespace: Optional[str] = field(
+        default=None,
+        metadata={
+            "description": (
+                "Kubernetes namespace to deploy flow to. "
+                "If not specified, will infer namespace from "
+                "deployment project name and environment."
+            )
+        },
     )
 
-    memory_gb: float = Field(
-        description="Amount of memory to allocate to flow in GB.",
-        gt=0,
-        le=256,
+    cache_namespaces: bool = field(
+        default=False,
+        metadata={
+            "description": (
+                "Keep a watch-backed cache of existing namespaces, for long-lived "
+                "processes building many deployments. Requires permission to list "
+                "and watch namespaces cluster-wide."
+            )
+        },
     )
 
+    def __post_init__(self) -> None:
+        if not 0 < self.cpu <= 64:
+            raise ValueError(f"cpu must be in (0, 64], got {self.cpu}")
+        if not 0 < self.memory_gb <= 256:
+            raise ValueError(f"memory_gb must be in (0, 256], got {self.memory_gb}")
+
+    @classmethod
+    def parse_obj(cls, obj: Dict[str, Any]) -> "eks":
+        """Build the builder from a dictionary."""
+        return cls(**obj)
+
     def _resolve_namespace(self, deployment: Deployment) -> str:
         """Resolve namespace from deployment project name and environment."""
         if self.namespace is None:
             # project_name = deployment.project_name
             # environment = deployment.environment
-            # self.namespace = f"{project_name}-{environment}"
-            self.namespace = deployment.name
+            # return f"{project_name}-{environment}"
+            return deployment.name
         return self.namespace
 
     def _ensure_namespace_exists(self, namespace: str) -> None:
         """Ensure namespace exists."""
-        with tempfile.TemporaryDirectory() as tmpdir:
-            namespace_file_path = Path(tmpdir) / "namespace.yaml"
-            with open(namespace_file_path, "w") as namespace_file:
-                subprocess.run(
-                    [
-                        "kubectl",
-                        "create",
-                        "namespace",
-                        namespace,
-                        "--dry-run=client",
-                        "-o",
-                        "yaml",
-                    ],
-                    stdout=namespace_file,
-                    check=True,
-                    cwd=tmpdir,
-                )
-                subprocess.run(
-                    [
-                        "kubectl",
-                        "apply",
-                        "-f",
-                        namespace_file_path,
-                        "--wait",
-                    ],
-                    check=True,
-                )
+        namespace_cache = _get_namespace_cache() if self.cache_namespaces else None
+        if namespace_cache is not None and namespace in namespace_cache:
+            return
+
+        body = client.V1Namespace(metadata=client.V1ObjectMeta(name=namespace))
+        core_v1_api = client.CoreV1Api(_get_api_client())
+        try:
+            _call_kube_api(core_v1_api.create_namespace, body=body)
+        except ApiException as exc:
+            # Namespace already exists
+            if exc.status != 409:
+                raise exc
+        if namespace_cache is not None:
+            namespace_cache.add(namespace)
 
     def update_deployment(self, deployment: Deployment) -> Deployment:
         """Update a deployment by building kubernetes Job and setting infra block."""
         namespace = self._resolve_namespace(deployment)
-        self._ensure_namespace_exists(namespace)
         infra_block = KubernetesJob(
             image=self.image,
             namespace=namespace,
@@ -141,3 +318,8 @@ class eks(BaseModel, DeployableFlowBuilderInterface):
 
         deployment.infrastructure = infra_block
         return deployment
+
+    async def realize_side_effects(self, deployment: Deployment) -> None:
+        """Ensure the namespace the flow runs in exists."""
+        namespace = self._resolve_namespace(deployment)
+        await run_sync_in_worker_thread(self._ensure_namespace_exists, namespace)
@@ -1,4 +1,5 @@
 """deployer interface."""
+import asyncio
 from abc import ABC, abstractmethod
 from typing import List, TYPE_CHECKING
 
@@ -33,6 +34,9 @@ if TYPE_CHECKING:
         def update_deployment(self, deployment: Deployment) -> Deployment:
             ...
 
+        async def realize_side_effects(self, deployment: Deployment) -> None:
+            ...
+
         def __call__(self, flow: Flow[P, R]) -> DeployableFlow[P, R]:
             ...
 
@@ -65,6 +69,12 @@ else:
             )
             for deployment_builder in self.deployment_builders:
                 deployment = deployment_builder.update_deployment(deployment)
+            await asyncio.gather(
+                *(
+                    deployment_builder.realize_side_effects(deployment)
+                    for deployment_builder in self.deployment_builders
+                )
+            )
             return deployment
 
     class DeployableFlowBuilderInterface(ABC):
@@ -72,8 +82,12 @@ else:
 
         @abstractmethod
         def update_deployment(self, deployment: Deployment) -> Deployment:
+            """Update the deployment, without any side effects."""
             ...
 
+        async def realize_side_effects(self, deployment: Deployment) -> None:
+            """Realize the side effects the updated deployment depends on."""
+
         def __call__(self, flow: Flow[P, R]) -> DeployableFlow:
             deployable_flow = DeployableFlow(flow)
             deployable_flow.deployment_builders.append(self)
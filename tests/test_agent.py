@@ -0,0 +1,232 @@
+"""Test the simple eks example agent."""
+import asyncio
+import importlib.util
+import json
+from pathlib import Path
+from types import ModuleType, SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+import pytest
+from kubernetes_asyncio import client
+from kubernetes_asyncio.client.exceptions import ApiException
+from prefect.context import use_profile
+from prefect.settings import Profile
+
+AGENT_PATH = Path(__file__).parents[1] / "examples" / "simple_eks" / "agent.py"
+
+
+def _load_agent_module() -> ModuleType:
+    spec = importlib.util.spec_from_file_location("simple_eks_agent", AGENT_PATH)
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+agent_module = _load_agent_module()
+
+
+@pytest.fixture
+def agent():
+    return agent_module.PrefectKubernetesAgent(
+        name="prefect-agent", namespace="prefect", image="my-image"
+    )
+
+
+class FakeApi:
+    """Fake read and patch api calls of a single resource."""
+
+    def __init__(self, live_annotations: Optional[Dict[str, str]]) -> None:
+        self.live_annotations = live_annotations
+        self.patches: List[Dict[str, Any]] = []
+
+    async def read(self, **kwargs: str) -> SimpleNamespace:
+        if self.live_annotations is None:
+            raise ApiException(status=404)
+        return SimpleNamespace(
+            metadata=SimpleNamespace(annotations=self.live_annotations)
+        )
+
+    async def patch(self, **kwargs: Any) -> None:
+        self.patches.append(kwargs)
+
+
+class FakeResponse:
+    """Fake aiohttp response."""
+
+    def __init__(self, status: int) -> None:
+        self.status = status
+        self.reason = "Not Found" if status == 404 else "OK"
+        self.headers = {"Content-Type": "application/json"}
+
+    async def read(self) -> bytes:
+        return b"{}"
+
+
+class FakeSession:
+    """Fake aiohttp session answering reads with 404 and everything else with 200."""
+
+    def __init__(self) -> None:
+        self.requests: List[Dict[str, Any]] = []
+
+    async def request(self, **kwargs: Any) -> FakeResponse:
+        self.requests.append(kwargs)
+        return FakeResponse(404 if kwargs["method"] == "GET" else 200)
+
+    async def close(self) -> None:
+        pass
+
+
+def test_with_spec_hash_is_stable_and_leaves_manifest_untouched():
+    """Test the spec hash only depends on the manifest content."""
+    manifest = {"kind": "Namespace", "metadata": {"name": "prefect"}}
+    reordered = {"metadata": {"name": "prefect"}, "kind": "Namespace"}
+    changed = {"kind": "Namespace", "metadata": {"name": "other"}}
+
+    hashed = agent_module._with_spec_hash(manifest)
+    annotation = agent_module.SPEC_HASH_ANNOTATION
+    spec_hash = hashed["metadata"]["annotations"][annotation]
+
+    assert manifest == {"kind": "Namespace", "metadata": {"name": "prefect"}}
+    assert agent_module._with_spec_hash(manifest) == hashed
+    assert (
+        agent_module._with_spec_hash(reordered)["metadata"]["annotations"][annotation]
+        == spec_hash
+    )
+    assert (
+        agent_module._with_spec_hash(changed)["metadata"]["annotations"][annotation]
+        != spec_hash
+    )
+
+
+@pytest.mark.parametrize(
+    "live_annotations, applied",
+    [
+        (None, True),
+        ({}, True),
+        ({"perfect-deployer.io/spec-hash": "stale"}, True),
+    ],
+)
+def test_server_side_apply_patches_missing_or_changed_resources(
+    agent, live_annotations, applied
+):
+    """Test resources are applied when missing or carrying another spec hash."""
+    body = agent_module._with_spec_hash({"metadata": {"name": "prefect"}})
+    api = FakeApi(live_annotations)
+
+    result = asyncio.run(
+        agent._server_side_apply(api.read, api.patch, body, name="prefect")
+    )
+
+    assert result is applied
+    assert api.patches == [
+        {
+            "body": body,
+            "field_manager": agent_module.FIELD_MANAGER,
+            "force": True,
+            "_content_type": "application/apply-patch+yaml",
+            "name": "prefect",
+        }
+    ]
+
+
+def test_server_side_apply_skips_resources_with_same_spec_hash(agent):
+    """Test resources already applied from the same manifest are skipped."""
+    body = agent_module._with_spec_hash({"metadata": {"name": "prefect"}})
+    api = FakeApi(body["metadata"]["annotations"])
+
+    result = asyncio.run(
+        agent._server_side_apply(api.read, api.patch, body, name="prefect")
+    )
+
+    assert result is False
+    assert api.patches == []
+
+
+def test_server_side_apply_sends_apply_patch_through_kubernetes_client(agent):
+    """Test a real patch call sends the manifest as an apply patch."""
+    body = agent_module._with_spec_hash(
+        {"apiVersion": "v1", "kind": "Namespace", "metadata": {"name": "prefect"}}
+    )
+    session = FakeSession()
+
+    async def apply() -> bool:
+        api_client = client.ApiClient()
+        await api_client.rest_client.pool_manager.close()
+        api_client.rest_client.pool_manager = session
+        agent._api_client = api_client
+        core_v1_api = client.CoreV1Api(api_client)
+        applied: bool = await agent._server_side_apply(
+            core_v1_api.read_namespace,
+            core_v1_api.patch_namespace,
+            body,
+            name="prefect",
+        )
+        return applied
+
+    assert asyncio.run(apply()) is True
+
+    read, patch = session.requests
+    assert read["method"] == "GET"
+    assert patch["method"] == "PATCH"
+    assert patch["headers"]["Content-Type"] == "application/apply-patch+yaml"
+    assert json.loads(patch["data"]) == body
+    assert "fieldManager=perfect-deployer" in patch["url"]
+    assert "force=True" in patch["url"] or "force=true" in patch["url"]
+
+
+def test_call_api_retries_overloaded_apiserver(agent, monkeypatch):
+    """Test api calls are retried when the apiserver is overloaded."""
+    monkeypatch.setattr(agent_module, "KUBE_API_RETRY_DELAY_SECONDS", 0)
+    responses: List[Any] = [ApiException(status=429), ApiException(status=503), "ok"]
+
+    async def call() -> Any:
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert asyncio.run(agent._call_api(call)) == "ok"
+    assert responses == []
+
+
+def test_templates_are_rendered_again_when_fields_change(agent):
+    """Test manifest templates follow changes to the agent fields."""
+
+    def image(templates: Dict[str, Any]) -> str:
+        container = templates["deployment"]["spec"]["template"]["spec"]["containers"]
+        return str(container[0]["image"])
+
+    assert image(agent._get_templates()) == "my-image"
+
+    agent.image = "other-image"
+    assert image(agent._get_templates()) == "other-image"
+
+    copied = agent.copy(update={"image": "copied-image"})
+    assert image(copied._get_templates()) == "copied-image"
+    assert image(agent._get_templates()) == "other-image"
+
+    constructed = agent_module.PrefectKubernetesAgent.construct(
+        name="prefect-agent", namespace="prefect", image="constructed-image"
+    )
+    assert image(constructed._get_templates()) == "constructed-image"
+
+
+def test_manifests_are_rendered_again_when_profile_changes(agent, monkeypatch):
+    """Test the deployment env follows the active prefect profile."""
+    monkeypatch.setattr(
+        agent_module, "_load_profile_env", lambda name: (("PROFILE_NAME", name),)
+    )
+
+    def env(manifests: Dict[str, Any]) -> Any:
+        spec = manifests["deployment"]["spec"]["template"]["spec"]
+        return spec["containers"][0]["env"]
+
+    with use_profile(Profile(name="first", settings={}, source=None)):
+        assert env(agent._get_manifests()) == [
+            {"name": "PROFILE_NAME", "value": "first"}
+        ]
+    with use_profile(Profile(name="second", settings={}, source=None)):
+        assert env(agent._get_manifests()) == [
+            {"name": "PROFILE_NAME", "value": "second"}
+        ]
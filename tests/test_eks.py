@@ -0,0 +1,249 @@
+"""Test eks infrastructure builder."""
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, cast, Dict, Iterator, List, Tuple, Union
+
+import pytest
+from kubernetes import watch
+from kubernetes.client.exceptions import ApiException
+from prefect.deployments import Deployment
+from urllib3.exceptions import ProtocolError
+
+import perfect_deployer.implementations.infra.eks as eks_module
+
+NamespaceList = Tuple[List[str], str]
+WatchEvent = Dict[str, Any]
+
+
+def _namespace(name: str, resource_version: str = "1") -> SimpleNamespace:
+    return SimpleNamespace(
+        metadata=SimpleNamespace(name=name, resource_version=resource_version)
+    )
+
+
+class FakeCoreV1Api:
+    """Fake core v1 api returning scripted namespace lists."""
+
+    def __init__(self, lists: List[Union[NamespaceList, Exception]]) -> None:
+        self.lists = lists
+
+    def list_namespace(self, **kwargs: object) -> SimpleNamespace:
+        result = self.lists.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        names, resource_version = result
+        return SimpleNamespace(
+            metadata=SimpleNamespace(resource_version=resource_version),
+            items=[_namespace(name) for name in names],
+        )
+
+
+class BlockingCoreV1Api:
+    """Fake core v1 api whose namespace list never returns."""
+
+    def list_namespace(self, **kwargs: object) -> SimpleNamespace:
+        threading.Event().wait()
+        raise AssertionError("unreachable")
+
+
+class FakeWatch:
+    """Fake watch yielding scripted events, then blocking forever."""
+
+    streams: List[List[Union[WatchEvent, Exception]]] = []
+    resource_versions: List[str] = []
+
+    def stream(
+        self, func: Callable[..., object], resource_version: str
+    ) -> Iterator[WatchEvent]:
+        FakeWatch.resource_versions.append(resource_version)
+        if FakeWatch.streams:
+            events = FakeWatch.streams.pop(0)
+            for event in events:
+                if isinstance(event, Exception):
+                    raise event
+                yield event
+        threading.Event().wait()
+
+
+@pytest.fixture
+def fake_watch(monkeypatch):
+    FakeWatch.streams = []
+    FakeWatch.resource_versions = []
+    monkeypatch.setattr(watch, "Watch", FakeWatch)
+    monkeypatch.setattr(eks_module._NamespaceCache, "retry_delay_seconds", 0)
+    return FakeWatch
+
+
+def _wait_for(condition: Callable[[], bool]) -> None:
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        time.sleep(0.01)
+
+
+def test_namespace_cache_contains_listed_and_watched_namespaces(fake_watch):
+    """Test namespace cache tracks listed namespaces and watch events."""
+    fake_watch.streams = [
+        [
+            {"type": "ADDED", "object": _namespace("b", "2")},
+            {"type": "DELETED", "object": _namespace("a", "3")},
+        ]
+    ]
+    cache = eks_module._NamespaceCache(FakeCoreV1Api([(["a"], "1")]))
+
+    _wait_for(lambda: "b" in cache and "a" not in cache)
+    assert fake_watch.resource_versions == ["1"]
+
+
+def test_namespace_cache_relists_when_resource_version_expired(fake_watch):
+    """Test namespace cache re-lists and resumes the watch on 410 Gone."""
+    fake_watch.streams = [[ApiException(status=410)]]
+    core_v1_api = FakeCoreV1Api([(["a"], "1"), (["c"], "5")])
+    cache = eks_module._NamespaceCache(core_v1_api)
+
+    _wait_for(lambda: "c" in cache and "a" not in cache)
+    _wait_for(lambda: FakeWatch.resource_versions == ["1", "5"])
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        ProtocolError("connection dropped"),
+        ApiException(status=500),
+        ApiException(status=429),
+    ],
+)
+def test_namespace_cache_recovers_from_transient_watch_errors(fake_watch, error):
+    """Test namespace cache re-lists and resumes the watch after transient errors."""
+    fake_watch.streams = [[error]]
+    core_v1_api = FakeCoreV1Api([(["a"], "1"), (["c"], "5")])
+    cache = eks_module._NamespaceCache(core_v1_api)
+
+    _wait_for(lambda: "c" in cache and "a" not in cache)
+    _wait_for(lambda: FakeWatch.resource_versions == ["1", "5"])
+    assert cache._thread is not None and cache._thread.is_alive()
+
+
+def test_namespace_cache_retries_failed_initial_list(fake_watch):
+    """Test namespace cache retries the initial list after a transient error."""
+    core_v1_api = FakeCoreV1Api([ApiException(status=503), (["a"], "1")])
+    cache = eks_module._NamespaceCache(core_v1_api)
+
+    _wait_for(lambda: "a" in cache)
+
+
+def test_namespace_cache_reports_miss_while_initial_list_hangs(fake_watch):
+    """Test namespace cache lookups do not block on a hung initial list."""
+    cache = eks_module._NamespaceCache(BlockingCoreV1Api())
+    cache.sync_timeout_seconds = 0.05
+
+    assert "a" not in cache
+
+
+@pytest.mark.parametrize("status", [401, 403])
+def test_namespace_cache_is_disabled_when_forbidden(fake_watch, capsys, status):
+    """Test namespace cache quietly reports misses without list permission."""
+    core_v1_api = FakeCoreV1Api([ApiException(status=status)])
+    cache = eks_module._NamespaceCache(core_v1_api)
+
+    assert "a" not in cache
+    assert cache._thread is not None
+    cache._thread.join(timeout=5)
+    assert "a" not in cache
+    assert capsys.readouterr().err == ""
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"cpu": 0, "memory_gb": 1},
+        {"cpu": 65, "memory_gb": 1},
+        {"cpu": 1, "memory_gb": 0},
+        {"cpu": 1, "memory_gb": 257},
+    ],
+)
+def test_eks_rejects_out_of_bounds_resources(kwargs):
+    """Test eks validates its cpu and memory bounds."""
+    with pytest.raises(ValueError):
+        eks_module.eks(**kwargs)
+
+
+def test_eks_image_defaults_to_image_env_variable(monkeypatch):
+    """Test eks image defaults to the IMAGE environment variable."""
+    monkeypatch.setenv("IMAGE", "my-image")
+    assert eks_module.eks(cpu=1, memory_gb=1).image == "my-image"
+
+    monkeypatch.delenv("IMAGE")
+    assert (
+        eks_module.eks(cpu=1, memory_gb=1).image
+        == "prefecthq/prefect:2-latest-kubernetes"
+    )
+
+
+def test_eks_parse_obj_builds_builder_from_dict():
+    """Test eks parse_obj builds the builder from a dictionary."""
+    builder = eks_module.eks.parse_obj(
+        {"cpu": 0.5, "memory_gb": 2, "image": "my-image", "namespace": "ns"}
+    )
+    assert builder == eks_module.eks(
+        cpu=0.5, memory_gb=2, image="my-image", namespace="ns"
+    )
+
+
+def test_eks_resolve_namespace_infers_namespace_without_mutating_builder():
+    """Test eks resolves namespace from the deployment name without mutating."""
+    builder = eks_module.eks(cpu=1, memory_gb=1)
+    deployment = cast(Deployment, SimpleNamespace(name="my-deployment"))
+
+    assert builder._resolve_namespace(deployment) == "my-deployment"
+    assert builder.namespace is None
+
+    builder = eks_module.eks(cpu=1, memory_gb=1, namespace="ns")
+    assert builder._resolve_namespace(deployment) == "ns"
+
+
+@pytest.mark.parametrize("value", ["0", "-1", "eight"])
+def test_kube_api_concurrency_rejects_invalid_values(monkeypatch, value):
+    """Test the kubernetes api concurrency must be a positive integer."""
+    monkeypatch.setenv("PERFECT_DEPLOYER_KUBE_CONCURRENCY", value)
+    with pytest.raises(ValueError, match="PERFECT_DEPLOYER_KUBE_CONCURRENCY"):
+        eks_module.get_kube_api_concurrency()
+
+
+def test_kube_api_concurrency_defaults_to_eight(monkeypatch):
+    """Test the kubernetes api concurrency defaults to eight."""
+    monkeypatch.delenv("PERFECT_DEPLOYER_KUBE_CONCURRENCY", raising=False)
+    assert eks_module.get_kube_api_concurrency() == 8
+
+
+def test_call_kube_api_retries_throttled_calls(monkeypatch):
+    """Test kubernetes api calls are retried when the apiserver is overloaded."""
+    monkeypatch.setattr(eks_module, "KUBE_API_RETRY_DELAY_SECONDS", 0)
+    responses: List[Union[str, Exception]] = [
+        ApiException(status=429),
+        ApiException(status=503),
+        "created",
+    ]
+
+    def create_namespace(body: str) -> str:
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert eks_module._call_kube_api(create_namespace, body="ns") == "created"
+    assert responses == []
+
+
+def test_call_kube_api_does_not_retry_client_errors(monkeypatch):
+    """Test kubernetes api calls failing with a client error are not retried."""
+    calls: List[str] = []
+
+    def create_namespace(body: str) -> str:
+        calls.append(body)
+        raise ApiException(status=409)
+
+    with pytest.raises(ApiException):
+        eks_module._call_kube_api(create_namespace, body="ns")
+    assert calls == ["ns"]
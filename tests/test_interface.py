@@ -27,3 +27,32 @@ def test_deployment_builder_returns_deployable_flow_when_wrapping_flow():
 
     deployment = add.build_deployment()
     assert isinstance(deployment, Deployment)
+
+
+def test_build_deployment_realizes_side_effects_after_updating_deployment():
+    """Test build deployment realizes side effects once all builders updated it."""
+    calls = []
+
+    class dummy(DeployableFlowBuilderInterface):
+        """Dummy deployment builder with side effects."""
+
+        def __init__(self, name: str) -> None:
+            self.name = name
+
+        def update_deployment(self, deployment: Deployment) -> Deployment:
+            calls.append(("update", self.name))
+            return deployment
+
+        async def realize_side_effects(self, deployment: Deployment) -> None:
+            calls.append(("realize", self.name))
+
+    @dummy("first")
+    @dummy("second")
+    @flow(name="add-with-side-effects")
+    def add_with_side_effects(x: int, y: int) -> int:
+        return x + y
+
+    deployment = add_with_side_effects.build_deployment()
+    assert isinstance(deployment, Deployment)
+    assert set(calls[:2]) == {("update", "first"), ("update", "second")}
+    assert set(calls[2:]) == {("realize", "first"), ("realize", "second")}
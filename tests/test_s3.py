@@ -0,0 +1,19 @@
+"""Test s3 flow storage builder."""
+from dataclasses import FrozenInstanceError
+
+import pytest
+
+from perfect_deployer.implementations.flow_storage.s3 import s3
+
+
+def test_s3_parse_obj_builds_builder_from_dict():
+    """Test s3 parse_obj builds the builder from a dictionary."""
+    builder = s3.parse_obj({"bucket": "my-bucket", "key": "my-flow"})
+    assert builder == s3(bucket="my-bucket", key="my-flow")
+
+
+def test_s3_is_immutable():
+    """Test s3 builder fields cannot be reassigned."""
+    builder = s3(bucket="my-bucket", key="my-flow")
+    with pytest.raises(FrozenInstanceError):
+        builder.bucket = "other-bucket"  # type: ignore[misc]